@@ -1,5 +1,6 @@
-from functools import lru_cache, wraps
-from time import monotonic, time
+from functools import _make_key, lru_cache, wraps
+from time import monotonic
+from typing import Optional
 
 
 def lru_cache_with_ttl(maxsize=128, typed=False, ttl=60):
@@ -33,18 +34,80 @@ def lru_cache_with_ttl(maxsize=128, typed=False, ttl=60):
     return decorator
 
 
-def ttl_lru_cache(seconds_to_live: int, maxsize: int = 128):
+class _Entry:
+    __slots__ = ("value", "expiry")
+
+    def __init__(self, value, expiry):
+        self.value = value
+        self.expiry = expiry
+
+
+def ttl_lru_cache(seconds_to_live: int, maxsize: Optional[int] = 128):
+    """
+    Time aware lru caching, entries are refreshed seconds_to_live
+    after they have been computed.
+    """
+
+    def decorator(func):
+        cache = {}
+        if maxsize is not None and maxsize <= 0:
+            # like functools.lru_cache, a size of 0 disables caching
+            @wraps(func)
+            def uncached(*args, **kwargs):
+                return func(*args, **kwargs)
+
+            uncached.cache_clear = cache.clear
+            return uncached
+
+        # dicts keep insertion order, taking a bounded entry out and putting
+        # it back on a hit keeps the least recently used entry first
+        cache_lookup = cache.pop if maxsize is not None else cache.__getitem__
+        cache_setitem = cache.__setitem__
+        make_key = _make_key
+        clock = monotonic
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs, False)
+            now = clock()
+            try:
+                entry = cache_lookup(key)
+            except KeyError:
+                if maxsize is not None and len(cache) >= maxsize:
+                    del cache[next(iter(cache))]
+            else:
+                if now < entry.expiry:
+                    cache_setitem(key, entry)
+                    return entry.value
+            value = func(*args, **kwargs)
+            cache_setitem(key, _Entry(value, now + seconds_to_live))
+            return value
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+def ttl_method_cache(seconds_to_live: int):
     """
-    Time aware lru caching
+    Time aware caching for methods without arguments, the result is
+    kept in a single slot on the instance.
     """
 
-    def wrapper(func):
-        @lru_cache(maxsize)
-        def inner(__ttl, *args, **kwargs):
-            # Note that __ttl is not passed down to func,
-            # as it's only used to trigger cache miss after some time
-            return func(*args, **kwargs)
+    def decorator(func):
+        name = f"_{func.__name__}_cache"
+
+        @wraps(func)
+        def wrapper(self):
+            now = monotonic()
+            entry = self.__dict__.get(name)
+            if entry is not None and now < entry.expiry:
+                return entry.value
+            value = func(self)
+            self.__dict__[name] = _Entry(value, now + seconds_to_live)
+            return value
 
-        return lambda *args, **kwargs: inner(time() // seconds_to_live, *args, **kwargs)
+        return wrapper
 
-    return wrapper
+    return decorator
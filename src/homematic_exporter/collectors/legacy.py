@@ -1,8 +1,11 @@
 import json
 import logging
-import xmlrpc
+import threading
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pprint import pformat
-from typing import Dict, Iterable, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from prometheus_client.core import GaugeMetricFamily, Metric
 from prometheus_client.registry import Collector
@@ -20,9 +23,12 @@ class HomeMaticLegacyCollector(Collector):
     auth = None
     reload_names_active = False
     mapped_names: Dict[str, str] = {}
-    metrics: Dict[str, GaugeMetricFamily] = {}
     supported_device_types = SUPPORTED_DEVICE_TYPES
     channels_with_errors_allowed = CHANNELS_WITH_ERRORS_ALLOWED
+    enum_all_states = True
+    multicall_supported = True
+    _dbg = False
+    max_workers = 16
 
     def __init__(self, host, port, auth, config_filename: Optional[str] = None):
         super().__init__()
@@ -30,6 +36,13 @@ class HomeMaticLegacyCollector(Collector):
             host=host, username=auth[0], password=auth[1], port=port
         )
         self.host = host
+        # workers live as long as the collector, so each keeps its own proxy
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="paramset"
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, GaugeMetricFamily] = {}
         self.default_mapped_names = True
         self.logger = logging.getLogger(self.__class__.__name__)
         if config_filename:
@@ -44,16 +57,16 @@ class HomeMaticLegacyCollector(Collector):
                 self.channels_with_errors_allowed = config.get(
                     "channels_with_errors_allowed", CHANNELS_WITH_ERRORS_ALLOWED
                 )
+                self.enum_all_states = config.get("enum_all_states", True)
 
     def generate_metrics(self):
         self.logger.info("Gathering metrics")
+        self._dbg = self.logger.isEnabledFor(logging.DEBUG)
         devices = self.client.devices
-        self.metrics["devicecount"] = GaugeMetricFamily(
-            f"{self.namespace}_devicecount",
-            "Number of processed/supported devices",
-            labels=("ccu",),
-        )
-        self.metrics["devicecount"].add_metric((self.host,), float(len(devices)))
+        self.metric_family(
+            "devicecount", "Number of processed/supported devices", ("ccu",)
+        ).add_metric((self.host,), float(len(devices)))
+        eligible: List[HomeMaticRPCDevice] = []
         for device in devices:
             if device.parent == "":
                 if device.type in self.supported_device_types:
@@ -63,7 +76,8 @@ class HomeMaticLegacyCollector(Collector):
                             device.address, device.type, devChildcount
                         )
                     )
-                    self.logger.debug(pformat(device))
+                    if self._dbg:
+                        self.logger.debug(pformat(device))
                 else:
                     self.logger.info(
                         "Found unsupported top-level device {} of type {}".format(
@@ -71,171 +85,270 @@ class HomeMaticLegacyCollector(Collector):
                         )
                     )
             if device.parent_type in self.supported_device_types:
-                self.logger.debug(
-                    "Found device {} of type {} in supported parent type {}".format(
-                        device.address, device.type, device.parent_type
+                if self._dbg:
+                    self.logger.debug(
+                        "Found device {} of type {} in supported parent type {}".format(
+                            device.address, device.type, device.parent_type
+                        )
                     )
-                )
-                self.logger.debug(pformat(device))
-
-                allowFailedChannel = False
-                invalidChannels = self.channels_with_errors_allowed.get(
-                    device.parent_type
-                )
-                if invalidChannels is not None:
-                    channel = int(device.address[device.address.find(":") + 1 :])
-                    if channel in invalidChannels:
-                        allowFailedChannel = True
+                    self.logger.debug(pformat(device))
 
                 if "VALUES" in device.paramsets:
-                    paramset = {}
-                    try:
-                        paramset = self.client.paramset(device.address, "VALUES")
-                    except xmlrpc.client.Fault:
-                        if allowFailedChannel:
-                            self.logger.debug(
-                                "Error reading paramset for device {} of type {} in parent type {} (expected)".format(
-                                    device.address, device.type, device.parent_type
-                                )
-                            )
-                        else:
-                            self.logger.debug(
-                                "Error reading paramset for device {} of type {} in parent type {} (unexpected)".format(
-                                    device.address, device.type, device.parent_type
-                                )
-                            )
-                            raise
-                    paramsetDescription = self.client.paramset_description(
-                        device.address, "VALUES"
+                    eligible.append(device)
+
+        paramsets = self.fetch_paramsets(eligible)
+        mapped_names = self.get_mappings()
+        for device in eligible:
+            paramset = paramsets[device.address]
+            mapped_name = self.resolve_mapped_name(device, mapped_names)
+            paramsetDescription, enumStates = self._paramset_description(device.address)
+            for key in paramsetDescription:
+                paramDesc = paramsetDescription.get(key)
+                paramType = paramDesc.get("TYPE")
+                if paramType in ["FLOAT", "INTEGER", "BOOL"]:
+                    self.process_single_value(
+                        device, mapped_name, paramType, key, paramset.get(key)
                     )
-                    for key in paramsetDescription:
-                        paramDesc = paramsetDescription.get(key)
-                        paramType = paramDesc.get("TYPE")
-                        if paramType in ["FLOAT", "INTEGER", "BOOL"]:
-                            self.process_single_value(
-                                device, paramType, key, paramset.get(key)
-                            )
-                        elif paramType == "ENUM":
-                            self.logger.debug(
-                                "Found {}: desc: {} key: {}".format(
-                                    paramType, paramDesc, paramset.get(key)
-                                )
-                            )
-                            self.process_enum(
-                                device,
-                                key,
-                                paramset.get(key),
-                                paramDesc.get("VALUE_LIST"),
-                            )
-                        else:
-                            # ATM Unsupported like HEATING_CONTROL_HMIP.PARTY_TIME_START,
-                            # HEATING_CONTROL_HMIP.PARTY_TIME_END, COMBINED_PARAMETER or ACTION
-                            self.logger.debug(
-                                "Unknown paramType {}, desc: {}, key: {}".format(
-                                    paramType, paramDesc, paramset.get(key)
-                                )
+                elif paramType == "ENUM":
+                    if self._dbg:
+                        self.logger.debug(
+                            "Found {}: desc: {} key: {}".format(
+                                paramType, paramDesc, paramset.get(key)
                             )
-
-                    if paramset:
+                        )
+                    self.process_enum(
+                        device,
+                        mapped_name,
+                        key,
+                        paramset.get(key),
+                        paramDesc.get("VALUE_LIST"),
+                        enumStates[key],
+                    )
+                else:
+                    # ATM Unsupported like HEATING_CONTROL_HMIP.PARTY_TIME_START,
+                    # HEATING_CONTROL_HMIP.PARTY_TIME_END, COMBINED_PARAMETER or ACTION
+                    if self._dbg:
                         self.logger.debug(
-                            "ParamsetDescription for {}".format(device.address)
+                            "Unknown paramType {}, desc: {}, key: {}".format(
+                                paramType, paramDesc, paramset.get(key)
+                            )
                         )
-                        self.logger.debug(pformat(paramsetDescription))
-                        self.logger.debug("Paramset for {}".format(device.address))
-                        self.logger.debug(pformat(paramset))
+
+            if paramset and self._dbg:
+                self.logger.debug("ParamsetDescription for {}".format(device.address))
+                self.logger.debug(pformat(paramsetDescription))
+                self.logger.debug("Paramset for {}".format(device.address))
+                self.logger.debug(pformat(paramset))
+
+    def fetch_paramsets(self, devices: List[HomeMaticRPCDevice]) -> Dict[str, dict]:
+        """
+        Fetch the VALUES paramset of all given devices with a single
+        system.multicall round-trip to the CCU. Falls back to parallel
+        single reads if the CCU does not support system.multicall.
+        """
+        if not devices:
+            return {}
+        if self.multicall_supported:
+            multicall = xmlrpc.client.MultiCall(self.client.proxy)
+            for device in devices:
+                multicall.getParamset(device.address, "VALUES")
+            try:
+                results = multicall()
+            except xmlrpc.client.Fault:
+                self.logger.info(
+                    "system.multicall not supported, falling back to parallel reads"
+                )
+                self.multicall_supported = False
+            else:
+                return {
+                    device.address: self.read_paramset(
+                        device, partial(results.__getitem__, index)
+                    )
+                    for index, device in enumerate(devices)
+                }
+
+        def read(device: HomeMaticRPCDevice) -> dict:
+            return self.read_paramset(
+                device,
+                partial(self._thread_proxy().getParamset, device.address, "VALUES"),
+            )
+
+        return dict(
+            zip(
+                (device.address for device in devices),
+                self._executor.map(read, devices),
+            )
+        )
+
+    def _thread_proxy(self) -> xmlrpc.client.ServerProxy:
+        # ServerProxy reuses a single connection and must not be shared between threads
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is None:
+            proxy = self._local.proxy = xmlrpc.client.ServerProxy(self.client.url)
+        return proxy
+
+    def read_paramset(
+        self,
+        device: HomeMaticRPCDevice,
+        read: Callable[[], dict],
+    ) -> dict:
+        try:
+            return read()
+        except xmlrpc.client.Fault:
+            if self.allow_failed_channel(device):
+                self.logger.debug(
+                    "Error reading paramset for device {} of type {} in parent type {} (expected)".format(
+                        device.address, device.type, device.parent_type
+                    )
+                )
+            else:
+                self.logger.debug(
+                    "Error reading paramset for device {} of type {} in parent type {} (unexpected)".format(
+                        device.address, device.type, device.parent_type
+                    )
+                )
+                raise
+        return {}
+
+    def allow_failed_channel(self, device: HomeMaticRPCDevice) -> bool:
+        invalidChannels = self.channels_with_errors_allowed.get(device.parent_type)
+        if invalidChannels is None:
+            return False
+        return int(device.address.rsplit(":", 1)[1]) in invalidChannels
+
+    @ttl_lru_cache(86400, maxsize=None)
+    def _paramset_description(
+        self, address: str
+    ) -> Tuple[dict, Dict[str, Tuple[str, ...]]]:
+        # Types and value lists of a channel only change with a firmware update.
+        # Value lists may repeat entries, which must not end up as duplicate
+        # series, so the distinct states of each enum are computed here once.
+        description = self.client.paramset_description(address, "VALUES")
+        enumStates = {
+            key: tuple(dict.fromkeys(paramDesc.get("VALUE_LIST") or ()))
+            for key, paramDesc in description.items()
+            if paramDesc.get("TYPE") == "ENUM"
+        }
+        return description, enumStates
 
     @ttl_lru_cache(3600)
-    def get_mappings(self):
+    def get_mappings(self) -> Dict[str, str]:
         if self.default_mapped_names:
             return {
                 mapping["address"]: mapping.get("name", "unknown")
                 for mapping in self.client.device_names()
             }
+        return self.mapped_names
 
-    def resolve_mapped_name(self, device: HomeMaticRPCDevice):
-        mapped_names = self.get_mappings()
-        if device.address in mapped_names.keys() and not device.default_device:
-            return mapped_names[device.address]
-        elif device.parent in mapped_names.keys():
-            return mapped_names[device.parent]
-        else:
-            return device.address
-
-    def process_single_value(self, device: HomeMaticRPCDevice, paramType, key, value):
-        self.logger.debug(
-            "Found {} param {} with value {}".format(paramType, key, value)
+    def resolve_mapped_name(
+        self,
+        device: HomeMaticRPCDevice,
+        mapped_names: Optional[Dict[str, str]] = None,
+    ):
+        if mapped_names is None:
+            mapped_names = self.get_mappings()
+        return (
+            (not device.default_device and mapped_names.get(device.address))
+            or mapped_names.get(device.parent)
+            or device.address
         )
 
+    def metric_family(
+        self, gaugename: str, documentation: str, labels: Tuple[str, ...]
+    ) -> GaugeMetricFamily:
+        """
+        Get or create a metric family, families are kept across scrapes
+        so only their samples have to be reset.
+        """
+        family = self.metrics.get(gaugename)
+        if family is None:
+            family = self.metrics[gaugename] = GaugeMetricFamily(
+                f"{self.namespace}_{gaugename}", documentation, labels=labels
+            )
+        return family
+
+    def process_single_value(
+        self, device: HomeMaticRPCDevice, mapped_name: str, paramType, key, value
+    ):
+        if self._dbg:
+            self.logger.debug(
+                "Found {} param {} with value {}".format(paramType, key, value)
+            )
+
         if value == "" or value is None:
             return
-        gaugename = key.lower()
-        if gaugename not in self.metrics:
-            self.metrics[gaugename] = GaugeMetricFamily(
-                f"{self.namespace}_{gaugename}",
-                "Metrics for " + key,
-                labels=(
-                    "ccu",
-                    "device",
-                    "device_type",
-                    "parent_device_type",
-                    "mapped_name",
-                ),
-            )
-        self.metrics[gaugename].add_metric(
+        self.metric_family(
+            key.lower(),
+            "Metrics for " + key,
+            ("ccu", "device", "device_type", "parent_device_type", "mapped_name"),
+        ).add_metric(
             (
                 self.host,
                 device.address,
                 device.type,
                 device.parent_type,
-                self.resolve_mapped_name(device),
+                mapped_name,
             ),
             float(value),
         )
 
-    def process_enum(self, device: HomeMaticRPCDevice, key, value, istates):
+    def process_enum(
+        self,
+        device: HomeMaticRPCDevice,
+        mapped_name: str,
+        key,
+        value,
+        istates,
+        states: Tuple[str, ...],
+    ):
         if value == "" or value is None:
-            self.logger.debug(f"Skipping processing enum {key} with empty value")
+            if self._dbg:
+                self.logger.debug(f"Skipping processing enum {key} with empty value")
             return
 
         gaugename = key.lower() + "_set"
-        self.logger.debug(
-            f"Found enum param {key} with value {value}, gauge {gaugename}"
-        )
-        if gaugename not in self.metrics:
-            self.metrics[gaugename] = GaugeMetricFamily(
-                f"{self.namespace}_{gaugename}",
-                "Metrics for " + key,
-                labels=[
-                    "ccu",
-                    "device",
-                    "device_type",
-                    "parent_device_type",
-                    "mapped_name",
-                    "state",
-                ],
+        if self._dbg:
+            self.logger.debug(
+                f"Found enum param {key} with value {value}, gauge {gaugename}"
             )
-        mapped_name_v = self.resolve_mapped_name(device)
-        state = istates[int(value)]
-        self.logger.debug(
-            "Setting {} to value {}/{}".format(mapped_name_v, str(value), state)
+        family = self.metric_family(
+            gaugename,
+            "Metrics for " + key,
+            (
+                "ccu",
+                "device",
+                "device_type",
+                "parent_device_type",
+                "mapped_name",
+                "state",
+            ),
         )
+        state = istates[int(value)]
+        if self._dbg:
+            self.logger.debug(
+                "Setting {} to value {}/{}".format(mapped_name, str(value), state)
+            )
 
-        for istate in istates:
-            self.metrics[gaugename].add_metric(
+        for istate in states if self.enum_all_states else (state,):
+            family.add_metric(
                 (
                     self.host,
                     device.address,
                     device.type,
                     device.parent_type,
-                    mapped_name_v,
+                    mapped_name,
                     istate,
                 ),
                 int(state == istate),
             )
 
     def collect(self) -> Iterable[Metric]:
-        self.generate_metrics()
-        for value in self.metrics.values():
-            yield value
-        self.metrics = {}
+        # metric families are shared between scrapes, so scrapes must not overlap
+        with self._lock:
+            for family in self.metrics.values():
+                family.samples.clear()
+            self.generate_metrics()
+            for value in self.metrics.values():
+                if value.samples:
+                    yield value
         return super().collect()
@@ -1,6 +1,19 @@
 from ipaddress import IPv4Address, IPv6Address
 import logging
-from typing import Dict, Iterable, Optional, Tuple, Union
+import sys
+from functools import cached_property
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from xml.etree.ElementTree import iterparse
 
 from prometheus_client.core import (  # ignore
     CounterMetricFamily,
@@ -9,13 +22,45 @@ from prometheus_client.core import (  # ignore
 )
 from prometheus_client.registry import Collector
 from pyccu3 import PyCCU3
-from pyccu3.objects.xml_api import PartyDate
+from pyccu3.objects.xml_api import HomeMaticDatapoint, PartyDate
 from pyccu3.enums import BOOLEAN, DataPointType, DataPointUnit
 
-from homematic_exporter.cache import ttl_lru_cache
+from homematic_exporter.cache import ttl_method_cache
+
 
+V = TypeVar("V")
+Labels = Tuple[str, ...]
+Metrics = Dict[str, Union[CounterMetricFamily, GaugeMetricFamily]]
 
-def floatify(value: Union[float, BOOLEAN, IPv6Address, IPv4Address, PartyDate]) -> float:
+LABELS: Labels = tuple(
+    map(
+        sys.intern,
+        (
+            "ccu",
+            "device_name",
+            "device_address",
+            "device_type",
+            "channel_name",
+            "room",
+            "function",
+        ),
+    )
+)
+RSSI_LABELS: Labels = LABELS + (sys.intern("direction"),)
+
+RSSI_DIRECTIONS = {
+    DataPointType.RSSI_DEVICE: sys.intern("ccu->device"),
+    DataPointType.RSSI_PEER: sys.intern("device->ccu"),
+}
+
+UNKNOWN = sys.intern("unknown")
+
+
+def floatify(
+    value: Union[float, BOOLEAN, IPv6Address, IPv4Address, PartyDate]
+) -> float:
+    if type(value) is float:
+        return value
     match value:
         case int() | float():
             return float(value)
@@ -24,6 +69,17 @@ def floatify(value: Union[float, BOOLEAN, IPv6Address, IPv4Address, PartyDate])
     return float(0.0)
 
 
+def index_unique(pairs: Iterable[Tuple[int, V]], ambiguous: V) -> Dict[int, V]:
+    """
+    Index the values by ise_id, ids which occur more than once
+    (e.g. a channel in several rooms) are mapped to ambiguous.
+    """
+    index: Dict[int, V] = {}
+    for ise_id, value in pairs:
+        index[ise_id] = ambiguous if ise_id in index else value
+    return index
+
+
 class HomeMaticCollector(Collector):
     namespace = "homematic"
 
@@ -37,212 +93,299 @@ class HomeMaticCollector(Collector):
         assert len(auth) > 2, "Please provide a valid session_id"
         self.client = PyCCU3(self.host, session_id=auth[1], verify=verify)
         self.logger = logging.getLogger(self.__class__.__name__)
+        self._intern: Dict[str, str] = {}
+
+    # The ise_id lookups are derived from the TTL cached lists and are
+    # dropped whenever their source list is fetched again.
 
-    @ttl_lru_cache(3600)
+    @ttl_method_cache(3600)
     def rooms(self):
+        self.__dict__.pop("_room_by_ise", None)
         return [room for room in self.client.roomlist().roomList.room]
 
-    @ttl_lru_cache(3100)
+    @ttl_method_cache(3100)
     def functions(self):
+        self.__dict__.pop("_function_by_ise", None)
         return [func for func in self.client.functionlist().functionList.function]
 
-    @ttl_lru_cache(3200)
+    @ttl_method_cache(3200)
     def devices(self):
+        self.__dict__.pop("_device_by_ise", None)
         return [device for device in self.client.devicelist().deviceList.device]
 
-    @ttl_lru_cache(60)
+    @cached_property
+    def _room_by_ise(self) -> Dict[int, str]:
+        return index_unique(
+            (
+                (channel.ise_id, room.name)
+                for room in self.rooms()
+                for channel in room.channel
+            ),
+            UNKNOWN,
+        )
+
+    @cached_property
+    def _function_by_ise(self) -> Dict[int, str]:
+        return index_unique(
+            (
+                (channel.ise_id, func.name)
+                for func in self.functions()
+                for channel in func.channel
+            ),
+            UNKNOWN,
+        )
+
+    @cached_property
+    def _device_by_ise(self) -> Dict[int, Tuple[str, str]]:
+        return index_unique(
+            (
+                (channel.ise_id, (device.address, device.device_type))
+                for device in self.devices()
+                for channel in device.channel
+            ),
+            (UNKNOWN, UNKNOWN),
+        )
+
     def get_room_of_device(self, ise_id: int):
-        found = [
-            room
-            for room in self.rooms()
-            for channel in room.channel
-            if channel.ise_id == ise_id
-        ]
-        if found and len(found) == 1:
-            return found[0].name
-        return "unknown"
-
-    @ttl_lru_cache(100)
+        self.rooms()
+        return self._room_by_ise.get(ise_id, UNKNOWN)
+
     def get_device_address_of_device(self, ise_id: int):
-        found = [
-            device
-            for device in self.devices()
-            for channel in device.channel
-            if channel.ise_id == ise_id
-        ]
-        if found and len(found) == 1:
-            return found[0].address, found[0].device_type
-        return "unknown", "unknown"
-
-    @ttl_lru_cache(94)
+        self.devices()
+        return self._device_by_ise.get(ise_id, (UNKNOWN, UNKNOWN))
+
     def get_function_of_device(self, ise_id: int):
-        found = [
-            func
-            for func in self.functions()
-            for channel in func.channel
-            if channel.ise_id == ise_id
-        ]
-        if found and len(found) == 1:
-            return found[0].name
-        return "unknown"
+        self.functions()
+        return self._function_by_ise.get(ise_id, UNKNOWN)
 
     def collect(self) -> Iterable[Metric]:
-        labels = [
-            "ccu",
-            "device_name",
-            "device_address",
-            "device_type",
-            "channel_name",
-            "room",
-            "function",
-        ]
-        metrics: Dict[str, Union[CounterMetricFamily, GaugeMetricFamily]] = {
+        metrics: Metrics = {
             "rssi": GaugeMetricFamily(
                 f"{self.namespace}_rssi",
                 "The RSSI value from either ccu to device or device to ccu",
-                labels=(labels + ["direction"]),
+                labels=RSSI_LABELS,
                 unit="dbm",
             ),
             "temperature": GaugeMetricFamily(
                 f"{self.namespace}_temperature",
                 "The Temperature of a Sensor in Celsius",
-                labels=labels,
+                labels=LABELS,
                 unit="celsius",
             ),
             "humidity": GaugeMetricFamily(
                 f"{self.namespace}_humidity",
                 "The measure humidity of a Sensor from 0-1",
-                labels=labels,
+                labels=LABELS,
                 unit="ratio",
             ),
             "battery": GaugeMetricFamily(
                 f"{self.namespace}_battery",
                 "The battery voltage of the device 0 means no battery installed",
-                labels=labels,
+                labels=LABELS,
                 unit="volts",
             ),
             "level": GaugeMetricFamily(
                 f"{self.namespace}_level",
                 "The level of blinds or heating circuits from 0-1 [0(CLOSED)/1(OPEN)]",
-                labels=labels,
+                labels=LABELS,
                 unit="ratio",
             ),
             "energy": CounterMetricFamily(
                 f"{self.namespace}_energy",
                 "The energy consumed by the device.",
-                labels=labels,
+                labels=LABELS,
                 unit="joules",
             ),
             "current": GaugeMetricFamily(
                 f"{self.namespace}_circuit",
                 "The current currently flowing through the circuit",
-                labels=labels,
+                labels=LABELS,
                 unit="amperes",
             ),
             "voltage": GaugeMetricFamily(
                 f"{self.namespace}_circuit",
                 "The voltage currently between the potentials of the circuit",
-                labels=labels,
+                labels=LABELS,
                 unit="volts",
             ),
             "power": GaugeMetricFamily(
                 f"{self.namespace}_circuit",
                 "The radiant flux in the circuit",
-                labels=labels,
+                labels=LABELS,
                 unit="joules_per_second",
             ),
         }
-        states = self.client.statelist()
-        for device in states.stateList.device:
-            for channel in device.channel:
-                device_address, device_type = self.get_device_address_of_device(
-                    channel.ise_id
-                )
-                room = self.get_room_of_device(channel.ise_id)
-                func = self.get_function_of_device(channel.ise_id)
-                base_labels = [
-                    self.host,
-                    device.name,
-                    device_address,
-                    device_type,
-                    channel.name,
-                    room,
-                    func,
-                ]
-                for datapoint in channel.datapoint:
-                    match datapoint.type:
-                        case DataPointType.RSSI_DEVICE | DataPointType.RSSI_PEER:
-                            direction = (
-                                "device->ccu"
-                                if datapoint.type == DataPointType.RSSI_PEER
-                                else "ccu->device"
-                            )
-                            metrics["rssi"].add_metric(
-                                labels=(base_labels + [direction]),
-                                value=floatify(datapoint.value),
-                            )
-                        case DataPointType.ACTUAL_TEMPERATURE | DataPointType.TEMPERATURE:
-                            metrics["temperature"].add_metric(
-                                labels=base_labels, value=floatify(datapoint.value)
-                            )
-                        case DataPointType.HUMIDITY:
-                            value = datapoint.value
-                            match datapoint.valueunit:
-                                case DataPointUnit.DECIMAL_PERCENT:
-                                    value = floatify(value) / 100
-                            metrics["humidity"].add_metric(
-                                labels=base_labels, value=floatify(value)
-                            )
-                        case DataPointType.LEVEL:
-                            match datapoint.valueunit:
-                                case DataPointUnit.PERCENT:
-                                    metrics["level"].add_metric(
-                                        labels=base_labels,
-                                        value=floatify(datapoint.value),
-                                    )
-                        case DataPointType.OPERATING_VOLTAGE:
-                            match datapoint.valueunit:
-                                case DataPointUnit.UNKNOWN:
-                                    metrics["battery"].add_metric(
-                                        labels=base_labels,
-                                        value=floatify(datapoint.value),
-                                    )
-                                case DataPointUnit.VOLTAGE:
-                                    ## I don't know why but only the socket powered devices seem to have the valueunit set.
-                                    pass
-                        case DataPointType.ENERGY_COUNTER:
-                            value = datapoint.value
-                            match datapoint.valueunit:
-                                case DataPointUnit.WATT_HOUR:
-                                    value = floatify(value) * 3600
-                                case DataPointUnit.WATT:
-                                    value = floatify(value) * 1
-                            metrics["energy"].add_metric(
-                                labels=base_labels, value=floatify(value)
-                            )
-                        case DataPointType.CURRENT:
-                            value = datapoint.value
-                            match datapoint.valueunit:
-                                case DataPointUnit.MILLI_AMPERE:
-                                    value = floatify(value) / 1000
-                            metrics["current"].add_metric(
-                                labels=base_labels, value=floatify(value)
-                            )
-                        case DataPointType.VOLTAGE:
-                            match datapoint.valueunit:
-                                case DataPointUnit.VOLTAGE:
-                                    metrics["voltage"].add_metric(
-                                        labels=base_labels,
-                                        value=floatify(datapoint.value),
-                                    )
-                        case DataPointType.POWER:
-                            match datapoint.valueunit:
-                                case DataPointUnit.WATT:
-                                    metrics["power"].add_metric(
-                                        labels=base_labels,
-                                        value=floatify(datapoint.value),
-                                    )
+        handlers = self._HANDLERS
+        # refetch expired lists once per scrape instead of once per channel
+        self.rooms()
+        self.functions()
+        self.devices()
+        room_by_ise = self._room_by_ise
+        function_by_ise = self._function_by_ise
+        device_by_ise = self._device_by_ise
+        # names are parsed fresh on every scrape, share one instance per value
+        intern = self._intern.setdefault
+        for device_name, channel_name, ise_id, datapoints in self.iter_channels():
+            device_address, device_type = device_by_ise.get(ise_id, (UNKNOWN, UNKNOWN))
+            room = room_by_ise.get(ise_id, UNKNOWN)
+            func = function_by_ise.get(ise_id, UNKNOWN)
+            base_labels = (
+                self.host,
+                intern(device_name, device_name),
+                device_address,
+                device_type,
+                intern(channel_name, channel_name),
+                room,
+                func,
+            )
+            for datapoint in datapoints:
+                handlers[datapoint.type](self, base_labels, datapoint, metrics)
 
         for metric in metrics.values():
             yield metric
         return super().collect()
+
+    def iter_channels(
+        self,
+    ) -> Iterator[Tuple[str, str, int, List[HomeMaticDatapoint]]]:
+        """
+        Stream the statelist of the CCU and yield the handled datapoints
+        channel by channel while the response is still being received,
+        so only a single device is kept in memory at a time.
+        """
+        with self.client.session.get(
+            self.client.path("statelist.cgi"), stream=True
+        ) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            device_name = ""
+            datapoints: List[HomeMaticDatapoint] = []
+            events = iterparse(response.raw, events=("start", "end"))
+            _, root = next(events)
+            if root.tag != "stateList":
+                # e.g. <not_authenticated/> for an expired session id
+                raise ValueError(f"Unexpected statelist response <{root.tag}>")
+            for event, element in events:
+                if event == "start":
+                    if element.tag == "device":
+                        device_name = element.get("name", "")
+                    continue
+                match element.tag:
+                    case "datapoint":
+                        if element.get("type") in self._HANDLED_TYPES:
+                            datapoints.append(
+                                HomeMaticDatapoint.from_dict(dict(element.attrib))
+                            )
+                    case "channel":
+                        yield (
+                            device_name,
+                            element.get("name", ""),
+                            int(element.get("ise_id")),
+                            datapoints,
+                        )
+                        datapoints = []
+                    case "device":
+                        root.clear()
+
+    def _handle_rssi(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        metrics["rssi"].add_metric(
+            labels=(base_labels + (RSSI_DIRECTIONS[datapoint.type],)),
+            value=floatify(datapoint.value),
+        )
+
+    def _handle_temperature(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        metrics["temperature"].add_metric(
+            labels=base_labels, value=floatify(datapoint.value)
+        )
+
+    def _handle_humidity(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        value = floatify(datapoint.value)
+        match datapoint.valueunit:
+            case DataPointUnit.DECIMAL_PERCENT:
+                value /= 100
+        metrics["humidity"].add_metric(labels=base_labels, value=value)
+
+    def _handle_level(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        match datapoint.valueunit:
+            case DataPointUnit.PERCENT:
+                metrics["level"].add_metric(
+                    labels=base_labels,
+                    value=floatify(datapoint.value),
+                )
+
+    def _handle_operating_voltage(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        match datapoint.valueunit:
+            case DataPointUnit.UNKNOWN:
+                metrics["battery"].add_metric(
+                    labels=base_labels,
+                    value=floatify(datapoint.value),
+                )
+            case DataPointUnit.VOLTAGE:
+                ## I don't know why but only the socket powered devices seem to have the valueunit set.
+                pass
+
+    def _handle_energy_counter(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        value = floatify(datapoint.value)
+        match datapoint.valueunit:
+            case DataPointUnit.WATT_HOUR:
+                value *= 3600
+        metrics["energy"].add_metric(labels=base_labels, value=value)
+
+    def _handle_current(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        value = floatify(datapoint.value)
+        match datapoint.valueunit:
+            case DataPointUnit.MILLI_AMPERE:
+                value /= 1000
+        metrics["current"].add_metric(labels=base_labels, value=value)
+
+    def _handle_voltage(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        match datapoint.valueunit:
+            case DataPointUnit.VOLTAGE:
+                metrics["voltage"].add_metric(
+                    labels=base_labels,
+                    value=floatify(datapoint.value),
+                )
+
+    def _handle_power(
+        self, base_labels: Labels, datapoint: HomeMaticDatapoint, metrics: Metrics
+    ):
+        match datapoint.valueunit:
+            case DataPointUnit.WATT:
+                metrics["power"].add_metric(
+                    labels=base_labels,
+                    value=floatify(datapoint.value),
+                )
+
+    _HANDLERS: Dict[
+        DataPointType,
+        Callable[["HomeMaticCollector", Labels, HomeMaticDatapoint, Metrics], None],
+    ] = {
+        DataPointType.RSSI_DEVICE: _handle_rssi,
+        DataPointType.RSSI_PEER: _handle_rssi,
+        DataPointType.ACTUAL_TEMPERATURE: _handle_temperature,
+        DataPointType.TEMPERATURE: _handle_temperature,
+        DataPointType.HUMIDITY: _handle_humidity,
+        DataPointType.LEVEL: _handle_level,
+        DataPointType.OPERATING_VOLTAGE: _handle_operating_voltage,
+        DataPointType.ENERGY_COUNTER: _handle_energy_counter,
+        DataPointType.CURRENT: _handle_current,
+        DataPointType.VOLTAGE: _handle_voltage,
+        DataPointType.POWER: _handle_power,
+    }
+    _HANDLED_TYPES = frozenset(datapoint_type.value for datapoint_type in _HANDLERS)
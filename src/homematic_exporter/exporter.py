@@ -3,6 +3,7 @@
 import argparse
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer
 from pprint import pformat
 from socketserver import ThreadingMixIn
@@ -16,7 +17,25 @@ from homematic_exporter.collectors.xml_api import HomeMaticCollector
 
 
 class _ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    """Thread per request HTTP server."""
+    """HTTP server handling requests on a fixed pool of threads."""
+
+    max_workers = 4
+    # idle clients must not be able to block a worker of the fixed pool forever
+    request_timeout = 30
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="http"
+        )
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
 
 
 def start_http_server(port, registry, addr=""):
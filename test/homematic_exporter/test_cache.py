@@ -0,0 +1,94 @@
+import pytest
+
+from homematic_exporter import cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "monotonic", clock)
+    return clock
+
+
+def test_ttl_lru_cache_hit_before_expiry(clock):
+    calls = []
+
+    @cache.ttl_lru_cache(60)
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    assert double(2) == 4
+    clock.now += 59
+    assert double(2) == 4
+    assert calls == [2]
+
+
+def test_ttl_lru_cache_refresh_after_expiry(clock):
+    calls = []
+
+    @cache.ttl_lru_cache(60)
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    double(2)
+    clock.now += 60
+    double(2)
+    assert calls == [2, 2]
+
+
+def test_ttl_lru_cache_evicts_least_recently_used(clock):
+    calls = []
+
+    @cache.ttl_lru_cache(60, maxsize=2)
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    double(1)
+    double(2)
+    double(1)
+    double(3)  # evicts 2, as 1 was used more recently
+    double(1)
+    double(2)
+    assert calls == [1, 2, 3, 2]
+
+
+def test_ttl_method_cache(clock):
+    class Collector:
+        calls = 0
+
+        @cache.ttl_method_cache(60)
+        def rooms(self):
+            self.calls += 1
+            return [self.calls]
+
+    collector = Collector()
+    assert collector.rooms() == [1]
+    clock.now += 59
+    assert collector.rooms() == [1]
+    clock.now += 1
+    assert collector.rooms() == [2]
+    assert Collector().rooms() == [1]
+
+
+def test_ttl_lru_cache_maxsize_zero_disables_caching(clock):
+    calls = []
+
+    @cache.ttl_lru_cache(60, maxsize=0)
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    assert double(2) == 4
+    assert double(2) == 4
+    assert calls == [2, 2]
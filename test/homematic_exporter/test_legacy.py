@@ -0,0 +1,118 @@
+import json
+import time
+import xmlrpc.client
+from types import SimpleNamespace
+
+import pytest
+
+from homematic_exporter.collectors.legacy import HomeMaticLegacyCollector
+
+
+def device(address, parent="", default_device=False):
+    return SimpleNamespace(
+        address=address, parent=parent, default_device=default_device
+    )
+
+
+def test_resolve_mapped_name_from_config(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(
+        json.dumps(
+            {"device_mapping": {"0011223344:1": "Window", "0011223344": "Garden"}}
+        )
+    )
+    collector = HomeMaticLegacyCollector(
+        "localhost", 2010, (None, None), config_filename=str(config_file)
+    )
+
+    assert collector.resolve_mapped_name(device("0011223344:1", "0011223344")) == (
+        "Window"
+    )
+    assert collector.resolve_mapped_name(device("0011223344:2", "0011223344")) == (
+        "Garden"
+    )
+    assert collector.resolve_mapped_name(device("5566778899:1", "5566778899")) == (
+        "5566778899:1"
+    )
+
+
+def channel(address, parent_type="HmIP-eTRV-2"):
+    return SimpleNamespace(address=address, type="CHANNEL", parent_type=parent_type)
+
+
+def paramset_collector(multicall):
+    collector = HomeMaticLegacyCollector("localhost", 2010, (None, None))
+    collector.channels_with_errors_allowed = {"HmIP-eTRV-2": [0]}
+    collector.client = SimpleNamespace(
+        url="http://localhost:2010",
+        proxy=SimpleNamespace(system=SimpleNamespace(multicall=multicall)),
+    )
+    return collector
+
+
+def test_fetch_paramsets_multicall():
+    calls = []
+
+    def multicall(batch):
+        calls.append(batch)
+        return [
+            {"faultCode": -1, "faultString": "Unknown instance"},
+            [{"ACTUAL_TEMPERATURE": 21.5}],
+        ]
+
+    collector = paramset_collector(multicall)
+
+    assert collector.fetch_paramsets([channel("ABC:0"), channel("ABC:1")]) == {
+        "ABC:0": {},
+        "ABC:1": {"ACTUAL_TEMPERATURE": 21.5},
+    }
+    assert [request["params"] for request in calls[0]] == [
+        ("ABC:0", "VALUES"),
+        ("ABC:1", "VALUES"),
+    ]
+    assert collector.multicall_supported
+
+
+def test_fetch_paramsets_multicall_unexpected_fault():
+    collector = paramset_collector(
+        lambda batch: [
+            [{"ACTUAL_TEMPERATURE": 21.5}],
+            {"faultCode": -1, "faultString": "Unknown instance"},
+        ]
+    )
+
+    with pytest.raises(xmlrpc.client.Fault):
+        collector.fetch_paramsets([channel("ABC:0"), channel("ABC:1")])
+
+
+def test_fetch_paramsets_falls_back_without_multicall(monkeypatch):
+    multicalls = []
+
+    def multicall(batch):
+        multicalls.append(batch)
+        raise xmlrpc.client.Fault(-32601, "system.multicall not found")
+
+    def get_paramset(address, paramset_type):
+        # finish out of order, results must still follow the device order
+        time.sleep(0.02 if address.endswith(":1") else 0)
+        return {"ADDRESS": address}
+
+    collector = paramset_collector(multicall)
+    monkeypatch.setattr(
+        collector,
+        "_thread_proxy",
+        lambda: SimpleNamespace(getParamset=get_paramset),
+    )
+    devices = [channel("ABC:1"), channel("ABC:2"), channel("ABC:3")]
+
+    result = collector.fetch_paramsets(devices)
+    assert list(result.items()) == [
+        ("ABC:1", {"ADDRESS": "ABC:1"}),
+        ("ABC:2", {"ADDRESS": "ABC:2"}),
+        ("ABC:3", {"ADDRESS": "ABC:3"}),
+    ]
+    assert not collector.multicall_supported
+
+    collector.fetch_paramsets(devices)
+    assert len(multicalls) == 1
+    assert not collector.multicall_supported
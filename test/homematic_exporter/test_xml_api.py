@@ -0,0 +1,151 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from homematic_exporter import cache
+from homematic_exporter.collectors.xml_api import HomeMaticCollector
+
+
+def roomlist(*rooms):
+    return SimpleNamespace(
+        roomList=SimpleNamespace(
+            room=[
+                SimpleNamespace(
+                    name=name,
+                    channel=[SimpleNamespace(ise_id=ise_id) for ise_id in ise_ids],
+                )
+                for name, ise_ids in rooms
+            ]
+        )
+    )
+
+
+def test_rooms_refresh_drops_room_lookup(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+    collector = HomeMaticCollector("ccu", auth=(None, "session", None))
+    collector.client = SimpleNamespace(
+        roomlist=lambda: roomlist(("Kitchen", [1]), ("Hall", [2, 3]), ("Bath", [3]))
+    )
+
+    assert collector.get_room_of_device(1) == "Kitchen"
+    # channels in several rooms are not attributed to any of them
+    assert collector.get_room_of_device(3) == "unknown"
+
+    collector.client.roomlist = lambda: roomlist(("Living", [1]))
+    assert collector.get_room_of_device(1) == "Kitchen"
+    now[0] += 3600
+    assert collector.get_room_of_device(1) == "Living"
+    assert collector.get_room_of_device(2) == "unknown"
+
+
+STATELIST = """<?xml version="1.0" encoding="ISO-8859-1" ?>
+<stateList>
+<device name="Thermostat Küche" ise_id="10" unreach="false" config_pending="false">
+<channel name="Thermostat Küche:0" ise_id="1" index="0" visible="true" operate="true">
+<datapoint name="a.RSSI_DEVICE" type="RSSI_DEVICE" ise_id="100" value="-60" valuetype="8" valueunit="" timestamp="0" operations="5"/>
+<datapoint name="a.UNREACH" type="UNREACH" ise_id="101" value="false" valuetype="2" valueunit="" timestamp="0" operations="5"/>
+</channel>
+<channel name="Thermostat Küche:1" ise_id="2" index="1" visible="true" operate="true">
+<datapoint name="a.HUMIDITY" type="HUMIDITY" ise_id="102" value="45" valuetype="16" valueunit="%" timestamp="0" operations="5"/>
+</channel>
+</device>
+<device name="Plug" ise_id="11" unreach="false" config_pending="false">
+<channel name="Plug:6" ise_id="3" index="6" visible="true" operate="true">
+<datapoint name="b.ENERGY_COUNTER" type="ENERGY_COUNTER" ise_id="103" value="2" valuetype="4" valueunit="Wh" timestamp="0" operations="5"/>
+<datapoint name="b.STATE" type="STATE" ise_id="104" value="true" valuetype="2" valueunit="" timestamp="0" operations="7"/>
+</channel>
+</device>
+</stateList>
+""".encode(
+    "latin-1"
+)
+
+
+def statelist_collector(body, status_code=200):
+    def get(url, **kwargs):
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = url
+        response.raw = io.BytesIO(body)
+        return response
+
+    collector = HomeMaticCollector("ccu", auth=(None, "session", None))
+    collector.client = SimpleNamespace(
+        session=SimpleNamespace(get=get),
+        path=lambda path: path,
+        roomlist=lambda: roomlist(("Kitchen", [1, 2])),
+        functionlist=lambda: SimpleNamespace(functionList=SimpleNamespace(function=[])),
+        devicelist=lambda: SimpleNamespace(
+            deviceList=SimpleNamespace(
+                device=[
+                    SimpleNamespace(
+                        address="ABC",
+                        device_type="HmIP-eTRV",
+                        channel=[SimpleNamespace(ise_id=1), SimpleNamespace(ise_id=2)],
+                    )
+                ]
+            )
+        ),
+    )
+    return collector
+
+
+def test_collect_streams_statelist():
+    collector = statelist_collector(STATELIST)
+
+    samples = {
+        (sample.name, tuple(sample.labels.values())): sample.value
+        for metric in collector.collect()
+        for sample in metric.samples
+    }
+
+    assert samples == {
+        (
+            "homematic_rssi_dbm",
+            (
+                "ccu",
+                "Thermostat Küche",
+                "ABC",
+                "HmIP-eTRV",
+                "Thermostat Küche:0",
+                "Kitchen",
+                "unknown",
+                "ccu->device",
+            ),
+        ): -60.0,
+        (
+            "homematic_humidity_ratio",
+            (
+                "ccu",
+                "Thermostat Küche",
+                "ABC",
+                "HmIP-eTRV",
+                "Thermostat Küche:1",
+                "Kitchen",
+                "unknown",
+            ),
+        ): 0.45,
+        (
+            "homematic_energy_joules_total",
+            ("ccu", "Plug", "unknown", "unknown", "Plug:6", "unknown", "unknown"),
+        ): 7200.0,
+    }
+
+
+def test_collect_fails_on_http_error():
+    collector = statelist_collector(b"", status_code=500)
+
+    with pytest.raises(requests.HTTPError):
+        list(collector.collect())
+
+
+def test_collect_fails_on_expired_session():
+    collector = statelist_collector(
+        b'<?xml version="1.0" encoding="ISO-8859-1" ?><not_authenticated/>'
+    )
+
+    with pytest.raises(ValueError):
+        list(collector.collect())